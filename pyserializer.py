@@ -1,6 +1,23 @@
+import codecs
+import io
 import json
 import logging
-from typing import TypedDict, IO
+import mmap
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from json.encoder import encode_basestring_ascii as _json_str
+from typing import TypedDict, IO, Callable, Iterable, Iterator, Optional, Union
+
+try:
+    import pyserializer_core as _core
+except ImportError:  # extension not built, use the pure python parser
+    _core = None
+# Interface of pyserializer_core this module is written against, see API there
+_CORE_API = 3
+
+_LOG = logging.getLogger(__name__)
 
 
 class CompanyData(TypedDict):
@@ -67,100 +84,626 @@ class Submission(TypedDict):
     DOCUMENT: list[Document]
 
 
-def deserialize(input: IO[str]) -> Submission:
+_SUBMISSION_STARTS = (b"<SUBMISSION>", b"<SEC-DOCUMENT>")
+# Closes the whole .txt filing, accepted as the end of any open field
+_SEC_DOC_END = b"</SEC-DOCUMENT>"
+
+# Encodings (codecs names) that keep every byte below 0x80 ASCII, so tag
+# lines can be split as bytes and decoded afterwards
+_ASCII_SUPERSETS = frozenset(("utf-8", "ascii", "iso8859-1", "cp1252"))
+
+# Leaf tags that may legitimately come without a value
+_LEAF_KEYS_ALLOWING_EMPTY = frozenset(("ORGANIZATION-NAME", "CONFIRMING-COPY",
+                                       "PRIVATE-TO-PUBLIC", "CORRECTION", "DELETION"))
+
+# Decoded tag names by their raw bytes, see _kintern. Shared with
+# pyserializer_core, _TEXT_KEY_CACHE is the one of _TextLineReader
+_KEY_CACHE: dict[bytes, str] = {}
+_TEXT_KEY_CACHE: dict[str, str] = {}
+_KEY_CACHE_SIZE = 4096
+
+# Smaller files are read as fast through _LineReader, mapping doesn't pay off.
+# Only the compiled parser maps files, in python reading lines is faster
+_MMAP_THRESHOLD = 1 << 20
+
+
+def deserialize(input: Union[IO[str], str, os.PathLike], keep_text: bool = True) -> Submission:
     """
     Processes the sec filing and returns a dictionary representing the data.
 
     Args:
-        input_data: the sec filing as IO object (open() or StringIO)
+        input_data: the sec filing as IO object (open() or StringIO) or a path.
+            With the compiled pyserializer_core, files of 1 MiB and more are
+            memory-mapped and parsed in place, anything else goes through a
+            buffered reader.
+        keep_text: if False the TEXT bodies of the documents are skipped and
+            left out, they are most of the file and often not needed.
 
     Returns:
         A dictionary representing the processed data.
     """
-    try:
-        # Read the first line
-        first_line = input.readline()
-        if not first_line.startswith(("<SUBMISSION>", "<SEC-DOCUMENT>")):
-            raise ValueError(
-                "Invalid file format, expected <SUBMISSION> or <SEC-DOCUMENT> at the start of the file")
+    fields = _with_input(input, partial(_deserialize_io, keep_text=keep_text))
 
-        fields: Submission = {}
-        process_nested_fields("SUBMISSION", fields, input)
+    # Test if the output is correct
+    expected_top_fields = ["DOCUMENT", "FILER"]
+    for field in expected_top_fields:
+        if field not in fields:
+            _LOG.warning("Warning: top level Field '%s' not found in the file: %s",
+                         field, getattr(input, 'name', input))
 
-        # Test if the output is correct
-        expected_top_fields = ["DOCUMENT", "FILER"]
-        for field in expected_top_fields:
-            if field not in fields:
-                logging.warning(f"Warning: top level Field '{
-                                field}' not found in the file: {input.name}")
+    return fields
 
-        return fields
+
+def _with_input(input: Union[IO, str, os.PathLike], parse: Callable[[IO], any]) -> any:
+    # Runs parse on the input, opening paths first, and logs what fails
+    try:
+        if isinstance(input, (str, os.PathLike)):
+            with open(input, "rb", buffering=1 << 16) as fh:
+                return parse(fh)
+        return parse(input)
     except Exception as e:
-        logging.error(f"Error processing input: {e}")
+        _LOG.error("Error processing input: %s", e)
         raise
 
 
-def process_nested_fields(field_name: str, fields: dict[str, any], reader: IO[str]) -> None:
-    while True:
-        line = reader.readline()
+def _deserialize_io(input: IO, keep_text: bool) -> Submission:
+    mapped = _mappable_source(input)
+    if mapped is not None:
+        fields = _deserialize_mapped(*mapped, keep_text)
+        if fields is not None:
+            return fields
+    fields: Submission = {}
+    _deserialize_lines(input, _FieldsBuilder(fields), keep_text)
+    return fields
+
+
+def _mappable_source(input: IO) -> Optional[tuple[IO[bytes], str, str, bool, int, int]]:
+    # The byte stream under input, how to decode it, whether lone '\r' end
+    # lines and the descriptor and offset to map it from. Only plain files
+    # can be mapped: StringIO has no descriptor and the one of e.g. a
+    # GzipFile belongs to the compressed file underneath
+    if _core is None:
+        return None
+    if isinstance(input, io.TextIOBase):
+        source = _text_file_source(input)
+    else:
+        source = _byte_source(input)
+    if source is None:
+        return None
+    buffer = source[0]
+    raw = getattr(buffer, "raw", buffer)
+    if not isinstance(raw, io.FileIO):
+        return None
+    fd = raw.fileno()
+    pos = buffer.tell()
+    if os.fstat(fd).st_size - pos < _MMAP_THRESHOLD:
+        return None
+    return (*source, fd, pos)
+
+
+def _text_file_source(input: IO[str]) -> Optional[tuple[IO[bytes], str, str, bool]]:
+    # The byte stream under a text file, if the compiled parser can read it
+    # in place of the wrapper
+    buffer = getattr(input, "buffer", None)
+    if (buffer is None or codecs.lookup(input.encoding).name not in _ASCII_SUPERSETS
+            or not input.seekable()):
+        return None
+    # The wrapper reads ahead of its position, seeking to it syncs the buffer.
+    # Positions carrying decoder state aren't plain byte offsets
+    try:
+        pos = input.tell()
+    except OSError:  # telling is disabled while iterating over the file
+        return None
+    if pos >> 64:
+        return None
+    input.seek(pos)
+    # There is no telling whether the wrapper translates newlines, open()
+    # does by default
+    return buffer, input.encoding, input.errors, True
+
+
+def _byte_source(input: IO) -> Optional[tuple[IO[bytes], str, str, bool]]:
+    # input with the encoding and errors to decode it and whether lone '\r'
+    # end lines, None if input has to be read as text. Text files are read
+    # through their wrapper, which knows how it splits lines
+    if isinstance(input, (io.RawIOBase, io.BufferedIOBase)):
+        return input, "utf-8", "strict", False
+    if isinstance(input, io.TextIOBase):
+        return None
+    # Streams outside the io hierarchy (codecs.open(), SpooledTemporaryFile,
+    # objects with just readline()) tell by what they read
+    read = getattr(input, "read", None)
+    if read is not None and isinstance(read(0), bytes):
+        return input, "utf-8", "strict", False
+    return None
+
+
+def _line_reader(input: IO) -> Union["_LineReader", "_TextLineReader"]:
+    source = _byte_source(input)
+    if source is None:
+        return _TextLineReader(input)
+    return _LineReader(*source[:3])
+
+
+class _LineReader:
+    """
+    Reads lines as bytes from a binary stream through a 64 KiB buffer. The
+    lines are split in C by the buffered stream's own readline(), a Python
+    level scan per line costs several times more than it saves. Keys and
+    values are decoded with decode() once the line is split.
+    """
+
+    # The tags the parser looks for, in the type of the lines
+    LT, GT, CLOSE = b"<", b">", b"</"
+    key_cache = _KEY_CACHE
+    SUBMISSION_STARTS = _SUBMISSION_STARTS
+    SUBMISSION_END, SEC_DOC_END, TEXT_END = b"</SUBMISSION>", _SEC_DOC_END, b"</TEXT>"
+
+    def __init__(self, fh: IO[bytes], encoding: str = "utf-8", errors: str = "strict", cap: int = 1 << 16):
+        if isinstance(fh, io.RawIOBase):  # unbuffered files, sockets, ...
+            fh = io.BufferedReader(fh, cap)
+        # Next line including its newline, empty at the end of the stream
+        self.next_line = fh.readline
+        self.encoding = encoding
+        self.errors = errors
+        if codecs.lookup(encoding).name == "utf-8" and errors == "strict":
+            self.decode = bytes.decode  # keyword arguments cost 4x the decode
+        else:
+            self.decode = partial(str, encoding=encoding, errors=errors)
+        self.encode = partial(str.encode, encoding=encoding, errors=errors)
+
+    def readline(self) -> str:
+        return self.decode(self.next_line())
+
+    def decode_text(self, raw: bytearray) -> str:
+        return _decode_text(raw, self.encoding, self.errors)
+
+    def read_until(self, tag: bytes, keep: bool = True) -> Optional[bytearray]:
+        """
+        Everything up to the next line starting with tag, that line is
+        consumed as well. None if the stream ends first, the lines are only
+        collected if keep is set.
+        """
+        content = bytearray()
+        next_line = self.next_line
+        while True:
+            line = next_line()
+            if not line:
+                return None
+            if line.startswith(tag):
+                return content
+            if keep:
+                content += line
+
+
+class _TextLineReader:
+    """
+    Reads lines from a text stream, e.g. a text mode open() or StringIO. The
+    stream splits the lines and translates their newlines as it is set up to.
+    """
+
+    LT, GT, CLOSE = "<", ">", "</"
+    key_cache = _TEXT_KEY_CACHE
+    SUBMISSION_STARTS = tuple(tag.decode() for tag in _SUBMISSION_STARTS)
+    SUBMISSION_END, SEC_DOC_END, TEXT_END = "</SUBMISSION>", _SEC_DOC_END.decode(), "</TEXT>"
+
+    # The lines are str already
+    decode = encode = str
+
+    def __init__(self, fh: IO[str]):
+        self.next_line = self.readline = fh.readline
+
+    def read_until(self, tag: str, keep: bool = True) -> Optional[str]:
+        """Same as _LineReader.read_until."""
+        content = []
+        next_line = self.next_line
+        while True:
+            line = next_line()
+            if not line:
+                return None
+            if line.startswith(tag):
+                return "".join(content)
+            if keep:
+                content.append(line)
+
+    def decode_text(self, text: str) -> str:
+        # The stream has translated the newlines already
+        return text
+
+
+def _deserialize_lines(input: IO, sink: "_Sink", keep_text: bool) -> None:
+    reader = _line_reader(input)
+    _check_first_line(reader.next_line(), reader.SUBMISSION_STARTS)
+    process_nested_fields(reader, sink, keep_text)
+
+
+def _check_first_line(first_line: Union[bytes, str], starts: tuple = _SUBMISSION_STARTS) -> None:
+    if not first_line.startswith(starts):
+        raise ValueError(
+            "Invalid file format, expected <SUBMISSION> or <SEC-DOCUMENT> at the start of the file")
+
+
+def _deserialize_mapped(buffer: IO[bytes], encoding: str, errors: str, universal_newlines: bool,
+                        fd: int, pos: int, keep_text: bool) -> Optional[Submission]:
+    # None if the file has to be read through its text wrapper instead
+    with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+        # The compiled parser splits lines at '\n' only, "\r\n" is fine
+        if universal_newlines and _core.has_lone_cr(mm, pos):
+            return None
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        eol = mm.find(b"\n", pos)
+        _check_first_line(mm[pos:eol] if eol >= 0 else mm[pos:])
+
+        fields: Submission = {}
+        pos = eol + 1 if eol >= 0 else len(mm)
+        stack = [(b"</SUBMISSION>", fields)]
+        end = _core.parse_nested_fields(mm, pos, stack, codecs.lookup(encoding).name, errors, keep_text)
+        # Leave the file after the last line read, as reading lines would
+        buffer.seek(end)
+        return fields
+
+
+def deserialize_many(paths: Iterable[Union[str, os.PathLike]], workers: Optional[int] = None,
+                     project: Optional[Callable[[Submission], any]] = None,
+                     keep_text: bool = True, chunksize: int = 16) -> Iterator[any]:
+    """
+    Processes many sec filings in parallel worker processes.
+
+    Args:
+        paths: the paths of the sec filings
+        workers: number of worker processes, os.cpu_count() by default
+        project: optional picklable function applied to each filing inside
+            the worker, so that only its result is sent back
+        keep_text: see deserialize
+        chunksize: number of paths handed to a worker at once
+
+    Returns:
+        An iterator over the processed filings (or their projection), in the
+        order of paths. Every path is submitted to the pool at once, closing
+        the iterator early still waits for the work already submitted.
+    """
+    if project is None:
+        work = partial(deserialize, keep_text=keep_text)
+    else:
+        work = partial(_deserialize_projected, project, keep_text)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(work, paths, chunksize=chunksize)
+
+
+def _deserialize_projected(project: Callable[[Submission], any], keep_text: bool, path: Union[str, os.PathLike]) -> any:
+    return project(deserialize(path, keep_text))
+
+
+def deserialize_flat(input: Union[IO[str], str, os.PathLike], keep_text: bool = True) -> tuple[list[str], list[Optional[str]], list[int]]:
+    """
+    Processes the sec filing into three parallel lists instead of nested
+    dictionaries, for callers that only look at a few fields.
+
+    Args:
+        input: the sec filing as IO object (open() or StringIO) or a path.
+        keep_text: see deserialize
+
+    Returns:
+        (keys, values, parents): record i is the field keys[i] with the value
+        values[i], None for a nested field, inside the nested field at index
+        parents[i], -1 at the top level. Repeated fields are repeated records,
+        a repeated TEXT too. to_nested() turns them into what deserialize()
+        returns.
+    """
+    records = _FlatRecords()
+    _with_input(input, partial(_deserialize_lines, sink=records, keep_text=keep_text))
+    return records.keys, records.values, records.parents
+
+
+def to_nested(keys: list[str], values: list[Optional[str]], parents: list[int]) -> Submission:
+    """
+    Builds the nested dictionaries of deserialize() from deserialize_flat()
+    records. Like deserialize(), the last of repeated TEXT records is kept.
+    """
+    fields: Submission = {}
+    nested: list[Optional[dict[str, any]]] = [None] * len(keys)
+    for i, (key, value, parent) in enumerate(zip(keys, values, parents)):
+        target = fields if parent < 0 else nested[parent]
+        if value is None:
+            value = nested[i] = {}
+        if key == "TEXT":
+            target[key] = value
+        else:
+            _store_field(target, key, value)
+    return fields
+
+
+def deserialize_to_json(input: Union[IO[str], str, os.PathLike], output: IO[str], keep_text: bool = True) -> None:
+    """
+    Processes the sec filing and writes it to output as JSON while parsing,
+    the dictionaries of deserialize() are never built. The JSON is the same
+    json.dump(deserialize(input), output) would write.
+
+    Args:
+        input: the sec filing as IO object (open() or StringIO) or a path.
+        output: the text stream the JSON is written to
+        keep_text: see deserialize
+
+    Repeated fields have to follow each other in the file, as they do in the
+    filings, a ValueError is raised otherwise. That includes a repeated TEXT,
+    of which the last one is kept. Output written before an error is left as
+    is.
+    """
+    writer = _JsonWriter(output)
+    _with_input(input, partial(_deserialize_lines, sink=writer, keep_text=keep_text))
+    writer.finish()
+
+
+class _FieldsBuilder:
+    """Event sink of deserialize, see process_nested_fields."""
+
+    def __init__(self, fields: dict[str, any]):
+        self._open = [fields]  # dictionaries of the open fields, innermost last
+        self._fields = fields
+
+    def value(self, key: str, value: str) -> None:
+        _store_field(self._fields, key, value)
+
+    def begin(self, key: str) -> None:
+        new_parent = {}
+        _store_field(self._fields, key, new_parent)
+        self._open.append(new_parent)
+        self._fields = new_parent
+
+    def end(self) -> None:
+        self._open.pop()
+        self._fields = self._open[-1]
+
+    def text(self, text: str) -> None:
+        # A repeated TEXT replaces the earlier one
+        self._fields["TEXT"] = text
+
+    def header(self, reader: Union["_LineReader", "_TextLineReader"]) -> None:
+        processTxtHeader(self._fields, reader)
+
+
+class _FlatRecords:
+    """Event sink of deserialize_flat, see process_nested_fields."""
+
+    def __init__(self):
+        self.keys: list[str] = []
+        self.values: list[Optional[str]] = []
+        self.parents: list[int] = []
+        self._open = [-1]  # record index of every open nested field
+
+    def value(self, key: str, value: Optional[str]) -> None:
+        self.keys.append(key)
+        self.values.append(value)
+        self.parents.append(self._open[-1])
+
+    def begin(self, key: str) -> None:
+        self.value(key, None)
+        self._open.append(len(self.keys) - 1)
+
+    def end(self) -> None:
+        self._open.pop()
+
+    def text(self, text: str) -> None:
+        self.value("TEXT", text)
+
+    def header(self, reader: Union[_LineReader, _TextLineReader]) -> None:
+        # The header is small, parse it as usual and flatten the result
+        fields = {}
+        processTxtHeader(fields, reader)
+        _flatten_fields(fields, self._open[-1],
+                        self.keys, self.values, self.parents)
+
+
+class _JsonWriter:
+    """
+    Event sink of deserialize_to_json, writes every field as soon as it is
+    parsed. Only the keys of the open objects are kept around.
+    """
+
+    def __init__(self, output: IO[str]):
+        self._write = output.write
+        # [keys seen, key of the array that is still open or None, TEXT not
+        # written yet or None] per object
+        self._open = []
+        self._open_object()
+
+    def _open_object(self) -> None:
+        self._write("{")
+        self._open.append([set(), None, None])
+
+    def _flush_text(self, state: list) -> None:
+        # The last of the TEXT bodies in a row is kept, it is only written
+        # once any other member follows
+        if state[2] is not None:
+            self._write(_json_str(state[2]))
+            state[2] = None
+
+    def _member(self, key: str, is_array: bool) -> None:
+        state = self._open[-1]
+        self._flush_text(state)
+        seen, array, _ = state
+        if array is not None:
+            if key == array:
+                self._write(", ")
+                return
+            self._write("]")
+            state[1] = None
+        if key in seen:
+            if is_array:
+                raise ValueError(
+                    f"Repeated field interrupted by other fields, can't be streamed: {key}")
+            raise ValueError(f"Duplicate key found in the file: {key}")
+        if seen:
+            self._write(", ")
+        seen.add(key)
+        self._write(f"{_json_str(key)}: ")
+        if is_array:
+            self._write("[")
+            state[1] = key
+
+    def value(self, key: str, value: str) -> None:
+        self._member(key, key in _ARRAY_FIELDS)
+        self._write(_json_str(value))
+
+    def begin(self, key: str) -> None:
+        self._member(key, key in _ARRAY_FIELDS)
+        self._open_object()
+
+    def end(self) -> None:
+        state = self._open[-1]
+        self._flush_text(state)
+        if state[1] is not None:
+            self._write("]")
+        self._write("}")
+        self._open.pop()
+
+    def text(self, text: str) -> None:
+        state = self._open[-1]
+        if state[2] is None:
+            if "TEXT" in state[0]:
+                raise ValueError(
+                    "Repeated field interrupted by other fields, can't be streamed: TEXT")
+            self._member("TEXT", False)
+        state[2] = text
+
+    def header(self, reader: Union[_LineReader, _TextLineReader]) -> None:
+        fields = {}
+        processTxtHeader(fields, reader)
+        for key, value in fields.items():
+            is_array = isinstance(value, list)
+            for item in value if is_array else (value,):
+                self._member(key, is_array)
+                self._write(json.dumps(item))
+
+    def finish(self) -> None:
+        # Fields left open by a truncated file are closed like the root
+        while self._open:
+            self.end()
+
+
+_Sink = Union[_FieldsBuilder, _FlatRecords, _JsonWriter]
+
+
+def process_nested_fields(reader: Union[_LineReader, _TextLineReader], sink: _Sink, keep_text: bool = True) -> None:
+    """
+    Parses the tag lines following the first line of the filing and reports
+    every field to sink: sink.value(key, value) for values, sink.begin(key)
+    and sink.end() around nested fields, sink.text(text) for TEXT bodies and
+    sink.header(reader) to read the SEC-HEADER.
+    """
+    next_line, decode = reader.next_line, reader.decode
+    lt, gt, close, sec_doc_end = reader.LT, reader.GT, reader.CLOSE, reader.SEC_DOC_END
+    store_value, begin, end = sink.value, sink.begin, sink.end
+    cache_get = reader.key_cache.get
+    # End tags of the open fields, innermost last
+    stack = [reader.SUBMISSION_END]
+    while stack:
+        end_tag = stack[-1]
+        line = next_line()
         if not line:
             break  # End of file
 
         # End of parent field
-        if line.startswith((f"</{field_name}>", "</SEC-DOCUMENT>")):
-            return
+        if line.startswith(end_tag) or line.startswith(sec_doc_end):
+            stack.pop()
+            if stack:
+                end()
+            continue
 
         # Split the line into key and value
-        if not line.startswith('<'):
+        if not line.startswith(lt):
             raise ValueError(
-                f"Invalid line format, expected '<' at start of line, in line: {line}")
+                f"Invalid line format, expected '<' at start of line, in line: {_show_line(line)}")
 
-        parts = line.split('>', 1)
-        if len(parts) < 2:
+        raw_key, found, value = line.partition(gt)
+        if not found:
             raise ValueError(
-                f"Invalid line format, expected '>' in line: {line}")
+                f"Invalid line format, expected '>' in line: {_show_line(line)}")
 
-        key = parts[0][1:].strip()
-        value = parts[1].strip()
+        raw_key = raw_key[1:].strip()
+        key = cache_get(raw_key)
+        if key is None:
+            key, raw_key = _kintern(raw_key, reader)
 
         if key == "TEXT":
-            content = []
-            while True:
-                line = reader.readline()
-                if not line:
-                    raise ValueError(
-                        "Unexpected end of file while reading TEXT field")
-
-                if line.startswith("</TEXT>"):
-                    fields[key] = ''.join(content)
-                    break
-                else:
-                    content.append(line)
+            content = reader.read_until(reader.TEXT_END, keep_text)
+            if content is None:
+                raise ValueError(
+                    "Unexpected end of file while reading TEXT field")
+            if keep_text:
+                sink.text(reader.decode_text(content))
         elif key == "SEC-HEADER":
-            processTxtHeader(fields, reader)
-        elif not value and key not in ["ORGANIZATION-NAME", "CONFIRMING-COPY", "PRIVATE-TO-PUBLIC", "CORRECTION", "DELETION"]:
-            # Nested field
-            if field_is_array(key):
-                if key not in fields:
-                    fields[key] = []
-                new_parent = {}
-                fields[key].append(new_parent)
-                process_nested_fields(key, new_parent, reader)
-            else:
-                if key in fields:
-                    raise ValueError(f"Duplicate key found in the file: {key}")
-                new_parent = {}
-                fields[key] = new_parent
-                process_nested_fields(key, new_parent, reader)
+            sink.header(reader)
         else:
-            if field_is_array(key):
-                if key not in fields:
-                    fields[key] = []
-                fields[key].append(value)
+            # Stripped once decoded, str.strip() also removes non-ASCII
+            # spaces like NBSP and the \x1c-\x1f separators
+            value = decode(value).strip()
+            if value or key in _LEAF_KEYS_ALLOWING_EMPTY:
+                store_value(key, value)
+            else:
+                # Nested field
+                stack.append(close + raw_key + gt)
+                begin(key)
+
+
+def _show_line(line: Union[bytes, str]) -> str:
+    return line if isinstance(line, str) else line.decode(errors='replace')
+
+
+def _flatten_fields(fields: dict[str, any], parent: int, keys: list[str], values: list[Optional[str]], parents: list[int]) -> None:
+    for key, value in fields.items():
+        for item in value if isinstance(value, list) else (value,):
+            keys.append(key)
+            parents.append(parent)
+            if isinstance(item, dict):
+                values.append(None)
+                _flatten_fields(item, len(keys) - 1, keys, values, parents)
             else:
-                if key in fields:
-                    raise ValueError(f"Duplicate key found in the file: {key}")
-                fields[key] = value
+                values.append(item)
+
+
+def _store_field(fields: dict[str, any], key: str, value: any) -> None:
+    # Fields of _ARRAY_FIELDS collect every occurrence, any other field may
+    # only appear once
+    if key in _ARRAY_FIELDS:
+        try:
+            fields[key].append(value)
+        except KeyError:
+            fields[key] = [value]
+    elif key in fields:
+        raise ValueError(f"Duplicate key found in the file: {key}")
+    else:
+        fields[key] = value
+
+
+def _kintern(raw_key: Union[bytes, str], reader: Union[_LineReader, _TextLineReader]) -> tuple[str, Union[bytes, str]]:
+    # Key cache miss, the parser looks the key up inline first: a filing uses
+    # a few dozen distinct tags thousands of times over. Returns the key and
+    # its raw form, which str.strip() may have cut further than bytes.strip()
+    decoded = reader.decode(raw_key)
+    key = sys.intern(decoded.strip())
+    if len(key) != len(decoded):
+        return key, reader.encode(key)
+    # Only ASCII keys are cached, they decode the same in every encoding
+    cache = reader.key_cache
+    if len(cache) < _KEY_CACHE_SIZE and raw_key.isascii():
+        cache[raw_key] = key
+    return key, raw_key
+
+
+def _process_header_bytes(fields: dict[str, any], raw: bytes, encoding: str = "utf-8",
+                          errors: str = "strict") -> None:
+    # The header is a few KB of "key: value" text, hand it over as is
+    processTxtHeader(fields, io.StringIO(_decode_text(raw, encoding, errors)))
+
+
+def _decode_text(raw: Union[bytes, bytearray], encoding: str = "utf-8", errors: str = "strict") -> str:
+    # Match what a text mode open() would have returned (universal newlines)
+    text = raw.decode(encoding, errors)
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
 
 
 KEY_MAP = {
@@ -210,16 +753,26 @@ KEY_MAP = {
 }
 
 
-def processTxtHeader(fields: dict[str, any], reader: IO[str]) -> None:
-    # 3rd element is the key of the current section, purely for logging
-    current_section_stack = [(fields, KEY_MAP, "")]
-    while len(current_section_stack) > 0:
-        fields, key_map, _ = current_section_stack[-1]
+def processTxtHeader(fields: dict[str, any], reader: Union[IO[str], _LineReader]) -> None:
+    # Sections are the dotted KEY_MAP paths of HEADER_SECTIONS, the root is
+    # "". The key table of the current section is only looked up on a switch
+    section = ""
+    section_fields = {"": fields}
+    current = fields
+    table = HEADER_SECTIONS[section]
+    while True:
         line = reader.readline()
 
-        if not line or line.strip() == "":
-            if len(fields.keys()) > 0 and len(current_section_stack) > 1:
-                current_section_stack.pop()
+        if not line:
+            raise ValueError(
+                "Unexpected end of file while reading SEC-HEADER field")
+
+        stripped = line.strip()
+        if not stripped:
+            if len(current) > 0 and section:
+                section = HEADER_PARENT_OF[section]
+                current = section_fields[section]
+                table = HEADER_SECTIONS[section]
             continue
 
         if line.startswith("</SEC-HEADER>"):
@@ -228,56 +781,74 @@ def processTxtHeader(fields: dict[str, any], reader: IO[str]) -> None:
         if line.startswith("<ACCEPTANCE-DATETIME>"):
             continue
 
-        parts = line.split(':', 1)
-        if len(parts) == 0:
-            raise ValueError(
-                f"Invalid line format in SEC-HEADER, expected ': in line: {line}")
-
-        key = parts[0].strip()
-        value = "" if len(parts) == 1 else parts[1].strip()
-
-        if key in key_map:
-            if isinstance(key_map[key], tuple):  # nested
-                orig_key = key_map[key][0]
-                if field_is_array(orig_key):
-                    if orig_key not in fields:
-                        fields[orig_key] = []
-                    new_parent = {}
-                    fields[orig_key].append(new_parent)
-                    current_section_stack.append(
-                        (new_parent, key_map[key][1], key))
-                else:
-                    if orig_key in fields:
-                        logging.warning(
-                            f"Duplicate key found in the file: {orig_key}")
-                    new_parent = {}
-                    fields[orig_key] = new_parent
-                    current_section_stack.append(
-                        (new_parent, key_map[key][1], key))
-
-            else:  # simple value
-                orig_key = key_map[key]
-                if field_is_array(orig_key):
-                    if orig_key not in fields:
-                        fields[orig_key] = []
-                    fields[orig_key].append(value)
-                else:
-                    if orig_key in fields:
-                        logging.warning(
-                            f"Duplicate key found in the file: {orig_key}")
-                    fields[orig_key] = value
+        # Section lines like "FILER:" have an empty value. The line is
+        # stripped already, only the inner sides of the colon are left
+        key, _, value = stripped.partition(':')
+        key = key.rstrip()
+        value = value.lstrip()
+
+        entry = table.get(key)
+        if entry is not None:
+            orig_key, child_section = entry
+            if child_section is not None:  # nested
+                value = {}
+            # Unlike the tag lines, the header keeps the last of duplicates
+            try:
+                _store_field(current, orig_key, value)
+            except ValueError:
+                _LOG.warning(
+                    "Duplicate key found in the file: %s", orig_key)
+                current[orig_key] = value
+            if child_section is not None:
+                section = child_section
+                section_fields[section] = current = value
+                table = HEADER_SECTIONS[section]
         elif not (not key or not value) and key != "ITEM INFORMATION":
-            logging.warning(
-                f"Unknown key in SEC-HEADER: key={key}, value={value}, section={current_section_stack[-1][2]}")
+            _LOG.warning(
+                "Unknown key in SEC-HEADER: key=%s, value=%s, section=%s", key, value, section)
+
+
+# Fields that can repeat and are therefore always stored as lists
+_ARRAY_FIELDS = frozenset((
+    "ITEMS", "FORMER-COMPANY", "DOCUMENT", "CLASS-CONTRACT", "FORMER-NAME",
+    "FILER", "SERIES", "GROUP-MEMBERS", "FILED-FOR", "REPORTING-OWNER",
+    "NEW-SERIES", "MERGER", "ITEM", "REFERENCES-429", "TARGET-DATA", "NEW-CLASSES-CONTRACTS",
+    "SUBJECT-COMPANY", "RULE"
+))
 
 
 def field_is_array(field: str) -> bool:
-    return field in [
-        "ITEMS", "FORMER-COMPANY", "DOCUMENT", "CLASS-CONTRACT", "FORMER-NAME",
-        "FILER", "SERIES", "GROUP-MEMBERS", "FILED-FOR", "REPORTING-OWNER",
-        "NEW-SERIES", "MERGER", "ITEM", "REFERENCES-429", "TARGET-DATA", "NEW-CLASSES-CONTRACTS",
-        "SUBJECT-COMPANY", "RULE"
-    ]
+    return field in _ARRAY_FIELDS
+
+
+def _flatten_key_map(key_map: dict[str, any], section: str, sections: dict, parent_of: dict) -> None:
+    # section -> header key -> (output key, entered section or None)
+    table = sections[section] = {}
+    for key, target in key_map.items():
+        if isinstance(target, tuple):
+            child_section = f"{section}.{key}" if section else key
+            table[key] = (target[0], child_section)
+            parent_of[child_section] = section
+            _flatten_key_map(target[1], child_section, sections, parent_of)
+        else:
+            table[key] = (target, None)
+
+
+HEADER_SECTIONS: dict[str, dict[str, tuple[str, Optional[str]]]] = {}
+HEADER_PARENT_OF: dict[str, str] = {}
+_flatten_key_map(KEY_MAP, "", HEADER_SECTIONS, HEADER_PARENT_OF)
+
+
+if _core is not None:
+    try:
+        if _core.API != _CORE_API:
+            raise TypeError(f"built for API {_core.API}, expected {_CORE_API}")
+        _core.bind(_ARRAY_FIELDS, _LEAF_KEYS_ALLOWING_EMPTY, _KEY_CACHE,
+                   _decode_text, _process_header_bytes)
+    except (AttributeError, TypeError) as e:
+        # A stale build of pyserializer_core.pyx, parse in python instead
+        _LOG.warning("pyserializer_core not used: %s", e)
+        _core = None
 
 
 # Example usage
@@ -0,0 +1,224 @@
+# cython: language_level=3
+"""
+Compiled parser of pyserializer for memory-mapped files, same grammar as
+pyserializer.process_nested_fields.
+
+Walks the mapped filing through a const char* with memchr/memcmp, Python
+objects are only created for the keys and values that end up in the dicts.
+The tables and the header/TEXT helpers stay in pyserializer and are handed
+over once with bind().
+"""
+from cpython.unicode cimport PyUnicode_Decode
+from libc.string cimport memchr, memcmp
+from sys import intern
+
+# Checked by pyserializer before bind(), bumped with every change of bind()
+# or parse_nested_fields()
+API = 3
+
+cdef frozenset _array_fields = frozenset()
+cdef frozenset _empty_leaf_keys = frozenset()
+cdef dict _key_cache = {}
+cdef Py_ssize_t _key_cache_size = 4096
+cdef object _decode_text = None
+cdef object _process_header = None
+
+
+def bind(array_fields, empty_leaf_keys, dict key_cache, decode_text, process_header):
+    global _array_fields, _empty_leaf_keys, _key_cache, _decode_text, _process_header
+    _array_fields = frozenset(array_fields)
+    _empty_leaf_keys = frozenset(empty_leaf_keys)
+    _key_cache = key_cache
+    _decode_text = decode_text
+    _process_header = process_header
+
+
+cdef inline bint _is_space(char c):
+    # The ASCII part of what str.strip() removes: bytes.strip() and the
+    # \x1c-\x1f separators
+    return (c == b' ' or c == b'\t' or c == b'\n' or c == b'\r' or c == b'\x0b' or c == b'\x0c'
+            or b'\x1c' <= c <= b'\x1f')
+
+
+cdef inline bint _non_ascii_ends(const char* buf, Py_ssize_t start, Py_ssize_t stop):
+    # Non-ASCII bytes may decode to spaces str.strip() removes, like NBSP
+    return start < stop and (<unsigned char>buf[start] >= 0x80 or <unsigned char>buf[stop - 1] >= 0x80)
+
+
+cdef inline bint _starts_with(const char* buf, Py_ssize_t start, Py_ssize_t stop, bytes prefix):
+    cdef Py_ssize_t size = len(prefix)
+    return stop - start >= size and memcmp(buf + start, <const char*>prefix, size) == 0
+
+
+cdef inline Py_ssize_t _line_end(const char* buf, Py_ssize_t n, Py_ssize_t pos):
+    cdef const char* eol = <const char*>memchr(buf + pos, b'\n', n - pos)
+    return n if eol == NULL else eol - buf
+
+
+cdef Py_ssize_t _find_line_start(const char* buf, Py_ssize_t n, Py_ssize_t pos, bytes tag):
+    # Offset of the first line at or after pos starting with tag, -1 if none
+    while pos < n:
+        if _starts_with(buf, pos, n, tag):
+            return pos
+        pos = _line_end(buf, n, pos) + 1
+    return -1
+
+
+cdef inline str _decode(const char* buf, Py_ssize_t start, Py_ssize_t stop, const char* encoding,
+                        const char* errors):
+    return PyUnicode_Decode(<char*>buf + start, stop - start, <char*>encoding, <char*>errors)
+
+
+cdef str _error_line(const char* buf, Py_ssize_t n, Py_ssize_t pos, Py_ssize_t eol):
+    # The line as the python parser shows it in errors, with its newline
+    return buf[pos:eol + 1 if eol < n else n].decode(errors='replace')
+
+
+cdef inline int _store(dict fields, str key, object value) except -1:
+    # Same rules as pyserializer._store_field
+    if key in _array_fields:
+        try:
+            fields[key].append(value)
+        except KeyError:
+            fields[key] = [value]
+    elif key in fields:
+        raise ValueError(f"Duplicate key found in the file: {key}")
+    else:
+        fields[key] = value
+    return 0
+
+
+cdef Py_ssize_t _parse(const char* buf, Py_ssize_t n, Py_ssize_t pos, list stack, str encoding, str errors,
+                       bint keep_text) except -1:
+    cdef Py_ssize_t eol, gt, ks, ke, vs, ve, close
+    cdef const char* found
+    cdef bytes end_tag
+    cdef dict fields, new_parent
+    cdef bytes raw_key
+    cdef str key, decoded, value
+    cdef bytes c_encoding = encoding.encode("ascii"), c_errors = errors.encode("ascii")
+    if not stack:
+        return pos
+    # The innermost field is kept in locals and only reloaded on push/pop
+    end_tag, fields = stack[-1]
+    while pos < n:
+        eol = _line_end(buf, n, pos)
+
+        # End of parent field
+        if _starts_with(buf, pos, eol, end_tag) or _starts_with(buf, pos, eol, b"</SEC-DOCUMENT>"):
+            stack.pop()
+            pos = eol + 1
+            if not stack:
+                break
+            end_tag, fields = stack[-1]
+            continue
+
+        # Split the line into key and value
+        if buf[pos] != b'<':
+            raise ValueError(
+                f"Invalid line format, expected '<' at start of line, in line: {_error_line(buf, n, pos, eol)}")
+
+        found = <const char*>memchr(buf + pos, b'>', eol - pos)
+        if found == NULL:
+            raise ValueError(
+                f"Invalid line format, expected '>' in line: {_error_line(buf, n, pos, eol)}")
+        gt = found - buf
+
+        ks = pos + 1
+        ke = gt
+        while ks < ke and _is_space(buf[ks]):
+            ks += 1
+        while ke > ks and _is_space(buf[ke - 1]):
+            ke -= 1
+        vs = gt + 1
+        ve = eol
+        while vs < ve and _is_space(buf[vs]):
+            vs += 1
+        while ve > vs and _is_space(buf[ve - 1]):
+            ve -= 1
+
+        raw_key = buf[ks:ke]
+        key = _key_cache.get(raw_key)
+        if key is None:
+            decoded = _decode(buf, ks, ke, c_encoding, c_errors)
+            key = intern(decoded.strip())
+            if len(key) != len(decoded):
+                # The end tag has the key as str.strip() leaves it
+                raw_key = key.encode(encoding, errors)
+            elif len(_key_cache) < _key_cache_size and raw_key.isascii():
+                # Only ASCII keys decode the same in every encoding
+                _key_cache[raw_key] = key
+        pos = eol + 1
+
+        if key == "TEXT":
+            close = _find_line_start(buf, n, pos, b"</TEXT>")
+            if close < 0:
+                raise ValueError(
+                    "Unexpected end of file while reading TEXT field")
+            if keep_text:
+                fields[key] = _decode_text(buf[pos:close], encoding, errors)
+            pos = _line_end(buf, n, close) + 1
+        elif key == "SEC-HEADER":
+            close = _find_line_start(buf, n, pos, b"</SEC-HEADER>")
+            if close < 0:
+                raise ValueError(
+                    "Unexpected end of file while reading SEC-HEADER field")
+            close = _line_end(buf, n, close) + 1
+            if close > n:
+                close = n
+            _process_header(fields, buf[pos:close], encoding, errors)
+            pos = close
+        else:
+            if _non_ascii_ends(buf, vs, ve):
+                value = _decode(buf, vs, ve, c_encoding, c_errors).strip()
+            elif vs < ve:
+                value = _decode(buf, vs, ve, c_encoding, c_errors)
+            else:
+                value = ""
+            if value or key in _empty_leaf_keys:
+                _store(fields, key, value)
+            else:
+                # Nested field
+                new_parent = {}
+                _store(fields, key, new_parent)
+                end_tag = b"</" + raw_key + b">"
+                fields = new_parent
+                stack.append((end_tag, fields))
+    return pos if pos < n else n
+
+
+def has_lone_cr(const unsigned char[::1] buf, Py_ssize_t pos=0):
+    """
+    Whether buf has a CR not followed by LF from pos on. Universal newlines
+    end a line there, parse_nested_fields doesn't.
+    """
+    cdef Py_ssize_t n = buf.shape[0]
+    cdef const char* start
+    cdef const char* found
+    if pos >= n:
+        return False
+    start = <const char*>&buf[0]
+    while pos < n:
+        found = <const char*>memchr(start + pos, b'\r', n - pos)
+        if found == NULL:
+            return False
+        pos = found - start + 1
+        if pos == n or start[pos] != b'\n':
+            return True
+    return False
+
+
+def parse_nested_fields(const unsigned char[::1] buf, Py_ssize_t pos, list stack, str encoding="utf-8",
+                        str errors="strict", bint keep_text=True):
+    """
+    Parses the tag lines of the mapped filing buf from pos on, stack holds
+    (end tag, fields) of the open fields, innermost last. buf is decoded with
+    encoding and errors, which must keep ASCII bytes ASCII.
+
+    Returns:
+        The offset right after the last consumed line.
+    """
+    cdef Py_ssize_t n = buf.shape[0]
+    if pos >= n:
+        return n
+    return _parse(<const char*>&buf[0], n, pos, stack, encoding, errors, keep_text)
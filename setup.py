@@ -1,4 +1,17 @@
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Extension
+
+try:
+    from Cython.Build import cythonize
+except ImportError:  # the pure python parser is used without the extension
+    ext_modules = []
+else:
+    ext_modules = cythonize(
+        [Extension("pyserializer_core", ["pyserializer_core.pyx"])],
+        language_level=3,
+    )
+    # A failed compile doesn't fail the install, the pure python parser is used
+    for ext in ext_modules:
+        ext.optional = True
 
 setup(
     name="pysecdeserializer",
@@ -6,7 +19,9 @@ setup(
     description="A package to deserialize SEC EDGAR .nc filings",
     author="Mohamed Miloudi",
     author_email="m.miloudi1357@gmail.com",
-    packages=find_packages(),
+    packages=find_packages(exclude=["tests", "tests.*"]),
+    py_modules=["pyserializer"],
+    ext_modules=ext_modules,
     install_requires=[],
     python_requires=">=3.7",
 )
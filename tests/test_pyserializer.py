@@ -0,0 +1,366 @@
+import codecs
+import importlib.util
+import io
+import json
+import os
+import sys
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+import pyserializer
+
+NC_FILING = """<SUBMISSION>
+<ACCESSION-NUMBER>0000950170-24-000001
+<TYPE>8-K
+<ITEMS>2.02
+<ITEMS>9.01
+<CONFIRMING-COPY>
+<FILER>
+<COMPANY-DATA>
+<CONFORMED-NAME>ACME "QUOTED" INC
+<CIK>0000000123
+<ORGANIZATION-NAME>
+</COMPANY-DATA>
+<FORMER-COMPANY>
+<FORMER-CONFORMED-NAME>ACME CORP
+</FORMER-COMPANY>
+<FORMER-COMPANY>
+<FORMER-CONFORMED-NAME>ACME LLC
+</FORMER-COMPANY>
+</FILER>
+<DOCUMENT>
+<TYPE>8-K
+<TEXT>
+<html>café &amp; "quotes"\t\\</html>
+  indented </TEXT> not the end
+</TEXT>
+</DOCUMENT>
+<DOCUMENT>
+<TYPE>EX-99
+<TEXT>
+</TEXT>
+</DOCUMENT>
+</SUBMISSION>
+"""
+
+TXT_FILING = """<SEC-DOCUMENT>0001045810-24-000028.txt : 20240221
+<SEC-HEADER>0001045810-24-000028.hdr.sgml : 20240221
+<ACCEPTANCE-DATETIME>20240221161735
+ACCESSION NUMBER:\t\t0001045810-24-000028
+CONFORMED SUBMISSION TYPE:\t10-K
+FILED AS OF DATE:\t\t20240221
+
+FILER:
+
+\tCOMPANY DATA:\t
+\t\tCOMPANY CONFORMED NAME:\t\t\tNVIDIA CORP
+\t\tCENTRAL INDEX KEY:\t\t\t0001045810
+
+\tBUSINESS ADDRESS:\t
+\t\tCITY:\t\t\tSANTA CLARA
+
+\tFORMER COMPANY:\t
+\t\tFORMER CONFORMED NAME:\tNVIDIA CORP/CA
+
+
+FILER:
+
+\tCOMPANY DATA:\t
+\t\tCOMPANY CONFORMED NAME:\t\t\tOTHER CO
+</SEC-HEADER>
+<DOCUMENT>
+<TYPE>10-K
+<TEXT>
+line one\r
+line two
+</TEXT>
+</DOCUMENT>
+</SEC-DOCUMENT>
+"""
+
+# Spaces str.strip() removes and bytes.strip() doesn't
+SPACES_FILING = """<SUBMISSION>
+<TYPE>8-K\xa0
+<\x1cCIK >\x1c0000000123\u3000
+<FILER\xa0>
+<COMPANY-DATA>\xa0
+<CONFORMED-NAME>\x85ACME INC
+</COMPANY-DATA>
+</FILER>
+</SUBMISSION>
+"""
+
+FILINGS = {"nc": NC_FILING, "txt": TXT_FILING, "spaces": SPACES_FILING}
+
+# Filings each parser has to reject with the same ValueError
+BROKEN_FILINGS = {
+    "duplicate": NC_FILING.replace("</FILER>\n", "</FILER>\n<TYPE>8-K\n"),
+    "no lt": NC_FILING.replace("</FILER>\n", "</FILER>\nTYPE>8-K\n"),
+    "no gt": NC_FILING.replace("</FILER>\n", "</FILER>\n<TYPE 8-K\n"),
+    "open text": NC_FILING[:NC_FILING.index("<html>")],
+    "open header": TXT_FILING[:TXT_FILING.index("FILER:")],
+}
+
+
+def parse_python(filing: bytes, keep_text: bool = True) -> dict:
+    fields = {}
+    reader = pyserializer._LineReader(io.BytesIO(filing))
+    reader.next_line()
+    pyserializer.process_nested_fields(
+        reader, pyserializer._FieldsBuilder(fields), keep_text)
+    return fields
+
+
+def parse_compiled(filing: bytes, keep_text: bool = True) -> dict:
+    fields = {}
+    pos = filing.index(b"\n") + 1
+    pyserializer._core.parse_nested_fields(
+        filing, pos, [(b"</SUBMISSION>", fields)], keep_text=keep_text)
+    return fields
+
+
+class DeserializeToJsonTest(unittest.TestCase):
+
+    def test_same_as_json_dump_of_deserialize(self):
+        for name, filing in FILINGS.items():
+            for keep_text in (True, False):
+                with self.subTest(filing=name, keep_text=keep_text):
+                    expected = json.dumps(pyserializer.deserialize(
+                        io.BytesIO(filing.encode()), keep_text))
+                    output = io.StringIO()
+                    pyserializer.deserialize_to_json(
+                        io.BytesIO(filing.encode()), output, keep_text)
+                    self.assertEqual(output.getvalue(), expected)
+
+    def test_last_of_repeated_texts(self):
+        filing = ("<SUBMISSION>\n<DOCUMENT>\n<TEXT>\none\n</TEXT>\n<TEXT>\ntwo\n</TEXT>\n"
+                  "<TYPE>8-K\n</DOCUMENT>\n</SUBMISSION>\n")
+        fields = pyserializer.deserialize(io.BytesIO(filing.encode()))
+        self.assertEqual(fields["DOCUMENT"], [{"TEXT": "two\n", "TYPE": "8-K"}])
+        output = io.StringIO()
+        pyserializer.deserialize_to_json(io.BytesIO(filing.encode()), output)
+        self.assertEqual(output.getvalue(), json.dumps(fields))
+
+    def test_interrupted_repeated_field(self):
+        for filing in ("<SUBMISSION>\n<ITEMS>1\n<TYPE>8-K\n<ITEMS>2\n</SUBMISSION>\n",
+                       "<SUBMISSION>\n<TEXT>\n</TEXT>\n<TYPE>8-K\n<TEXT>\n</TEXT>\n</SUBMISSION>\n"):
+            with self.subTest(filing=filing):
+                with self.assertRaises(ValueError):
+                    pyserializer.deserialize_to_json(
+                        io.BytesIO(filing.encode()), io.StringIO())
+
+
+class DeserializeFlatTest(unittest.TestCase):
+
+    def test_to_nested_gives_deserialize(self):
+        for name, filing in FILINGS.items():
+            with self.subTest(filing=name):
+                records = pyserializer.deserialize_flat(
+                    io.BytesIO(filing.encode()))
+                self.assertEqual(pyserializer.to_nested(*records),
+                                 pyserializer.deserialize(io.BytesIO(filing.encode())))
+
+    def test_last_of_repeated_texts(self):
+        filing = "<SUBMISSION>\n<TEXT>\none\n</TEXT>\n<TYPE>8-K\n<TEXT>\ntwo\n</TEXT>\n</SUBMISSION>\n"
+        keys, values, parents = pyserializer.deserialize_flat(io.BytesIO(filing.encode()))
+        self.assertEqual(keys, ["TEXT", "TYPE", "TEXT"])
+        self.assertEqual(pyserializer.to_nested(keys, values, parents),
+                         pyserializer.deserialize(io.BytesIO(filing.encode())))
+
+
+class DeserializeTextTest(unittest.TestCase):
+
+    def test_encoding_of_the_text_stream(self):
+        expected = pyserializer.deserialize(io.BytesIO(NC_FILING.encode()))
+        for encoding in ("latin-1", "cp1252", "utf-16"):
+            with self.subTest(encoding=encoding):
+                text = io.TextIOWrapper(io.BytesIO(NC_FILING.encode(encoding)), encoding)
+                self.assertEqual(pyserializer.deserialize(text), expected)
+
+    def test_string_io(self):
+        for name, filing in FILINGS.items():
+            with self.subTest(filing=name):
+                self.assertEqual(pyserializer.deserialize(io.StringIO(filing, newline=None)),
+                                 pyserializer.deserialize(io.BytesIO(filing.encode())))
+
+    def test_strips_like_str_strip(self):
+        expected = {"TYPE": "8-K", "CIK": "0000000123",
+                    "FILER": [{"COMPANY-DATA": {"CONFORMED-NAME": "ACME INC"}}]}
+        self.assertEqual(pyserializer.deserialize(io.BytesIO(SPACES_FILING.encode())), expected)
+        self.assertEqual(pyserializer.deserialize(io.StringIO(SPACES_FILING)), expected)
+
+    def test_str_keys_stay_out_of_the_byte_key_cache(self):
+        with mock.patch.dict(pyserializer._KEY_CACHE, clear=True):
+            pyserializer.deserialize(io.StringIO(NC_FILING))
+            self.assertEqual(pyserializer._KEY_CACHE, {})
+        self.assertIn("TYPE", pyserializer._TEXT_KEY_CACHE)
+
+    def test_text_streams_outside_the_io_classes(self):
+        expected = pyserializer.deserialize(io.BytesIO(NC_FILING.encode()))
+
+        class LinesOnly:
+            def __init__(self, text):
+                self.readline = io.StringIO(text).readline
+
+        with tempfile.SpooledTemporaryFile(mode="w+") as spooled:
+            spooled.write(NC_FILING)
+            spooled.seek(0)
+            self.assertEqual(pyserializer.deserialize(spooled), expected)
+        self.assertEqual(pyserializer.deserialize(LinesOnly(NC_FILING)), expected)
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        for encoding in ("latin-1", "utf-16"):
+            with self.subTest(encoding=encoding):
+                with open(path, "w", encoding=encoding, newline="") as f:
+                    f.write(NC_FILING)
+                with codecs.open(path, encoding=encoding) as f:
+                    self.assertEqual(pyserializer.deserialize(f), expected)
+
+    def test_universal_newlines(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        for name, filing in FILINGS.items():
+            with self.subTest(filing=name):
+                with open(path, "wb") as f:
+                    f.write(filing.replace("\r", "").replace("\n", "\r").encode())
+                with open(path) as f:
+                    self.assertEqual(pyserializer.deserialize(f),
+                                     pyserializer.deserialize(io.BytesIO(filing.encode())))
+
+    def test_from_the_stream_position(self):
+        text = io.TextIOWrapper(io.BytesIO(("preamble\n" + NC_FILING).encode()), "utf-8")
+        text.readline()
+        self.assertEqual(pyserializer.deserialize(text),
+                         pyserializer.deserialize(io.BytesIO(NC_FILING.encode())))
+
+
+class KeepTextTest(unittest.TestCase):
+
+    def test_text_left_out(self):
+        fields = pyserializer.deserialize(io.BytesIO(NC_FILING.encode()), keep_text=False)
+        self.assertEqual([document.keys() for document in fields["DOCUMENT"]], [{"TYPE"}, {"TYPE"}])
+        keys, _, _ = pyserializer.deserialize_flat(io.BytesIO(NC_FILING.encode()), keep_text=False)
+        self.assertNotIn("TEXT", keys)
+
+    def test_unterminated_text_still_raises(self):
+        filing = BROKEN_FILINGS["open text"]
+        for source in (lambda: io.BytesIO(filing.encode()), lambda: io.StringIO(filing)):
+            with self.assertRaisesRegex(ValueError, "while reading TEXT"):
+                pyserializer.deserialize(source(), keep_text=False)
+        if pyserializer._core is not None:
+            with self.assertRaisesRegex(ValueError, "while reading TEXT"):
+                parse_compiled(filing.encode(), keep_text=False)
+
+
+def document_types(fields: dict) -> list:
+    # Projection of DeserializeManyTest, module level to be picklable
+    return [(document["TYPE"], "TEXT" in document) for document in fields["DOCUMENT"]]
+
+
+class DeserializeManyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.paths = []
+        for name, filing in (("nc", NC_FILING), ("txt", TXT_FILING), ("nc2", NC_FILING)):
+            fd, path = tempfile.mkstemp(suffix=name)
+            with os.fdopen(fd, "wb") as f:
+                f.write(filing.encode())
+            self.addCleanup(os.remove, path)
+            self.paths.append(path)
+
+    def test_in_order(self):
+        results = list(pyserializer.deserialize_many(self.paths, workers=2, chunksize=1))
+        self.assertEqual(results, [pyserializer.deserialize(path) for path in self.paths])
+
+    def test_project_and_keep_text(self):
+        results = list(pyserializer.deserialize_many(
+            self.paths, workers=2, project=document_types, keep_text=False, chunksize=1))
+        self.assertEqual(results, [[("8-K", False), ("EX-99", False)], [("10-K", False)],
+                                   [("8-K", False), ("EX-99", False)]])
+
+    def test_worker_error(self):
+        with open(self.paths[1], "wb") as f:
+            f.write(BROKEN_FILINGS["duplicate"].encode())
+        with self.assertRaisesRegex(ValueError, "Duplicate key"):
+            list(pyserializer.deserialize_many(self.paths, workers=2, chunksize=1))
+
+
+@unittest.skipIf(pyserializer._core is None, "pyserializer_core is not built")
+class CoreParityTest(unittest.TestCase):
+
+    def test_same_fields(self):
+        for name, filing in FILINGS.items():
+            for keep_text in (True, False):
+                with self.subTest(filing=name, keep_text=keep_text):
+                    self.assertEqual(parse_compiled(filing.encode(), keep_text),
+                                     parse_python(filing.encode(), keep_text))
+
+    def test_same_errors(self):
+        for name, filing in BROKEN_FILINGS.items():
+            filing = filing.encode()
+            with self.subTest(filing=name):
+                with self.assertRaises(ValueError) as python_error:
+                    parse_python(filing)
+                with self.assertRaises(ValueError) as compiled_error:
+                    parse_compiled(filing)
+                self.assertEqual(str(compiled_error.exception),
+                                 str(python_error.exception))
+
+
+@unittest.skipIf(pyserializer._core is None, "pyserializer_core is not built")
+class MappedFileTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(pyserializer, "_MMAP_THRESHOLD", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def write(self, data: bytes) -> None:
+        with open(self.path, "wb") as f:
+            f.write(data)
+
+    def test_encoding_of_the_text_file(self):
+        expected = pyserializer.deserialize(io.BytesIO(NC_FILING.encode()))
+        self.write(NC_FILING.encode("latin-1"))
+        with open(self.path, encoding="latin-1") as f:
+            with mock.patch.object(pyserializer, "_deserialize_lines") as stream:
+                self.assertEqual(pyserializer.deserialize(f), expected)
+        stream.assert_not_called()
+
+    def test_lone_carriage_returns_are_read_as_text(self):
+        self.write(NC_FILING.replace("\n", "\r").encode())
+        with open(self.path) as f:
+            self.assertEqual(pyserializer.deserialize(f),
+                             pyserializer.deserialize(io.BytesIO(NC_FILING.encode())))
+
+    def test_from_the_file_position(self):
+        self.write(("preamble\n" + NC_FILING + "trailer\n").encode())
+        with open(self.path) as f:
+            f.readline()
+            self.assertEqual(pyserializer.deserialize(f),
+                             pyserializer.deserialize(io.BytesIO(NC_FILING.encode())))
+            self.assertEqual(f.read(), "trailer\n")
+
+
+class CoreFallbackTest(unittest.TestCase):
+
+    def test_stale_build_is_not_used(self):
+        stale = types.ModuleType("pyserializer_core")  # no API, like old builds
+        spec = importlib.util.find_spec("pyserializer")
+        module = importlib.util.module_from_spec(spec)
+        with mock.patch.dict(sys.modules, {"pyserializer_core": stale}):
+            with self.assertLogs("pyserializer", "WARNING"):
+                spec.loader.exec_module(module)
+        self.assertIsNone(module._core)
+
+
+if __name__ == "__main__":
+    unittest.main()